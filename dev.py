@@ -0,0 +1,11 @@
+## development launcher , single worker with auto-reload on code changes
+## for the production settings (uvloop/httptools, multiple workers) run main.py
+import uvicorn
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "main:app",      # "filename:app_instance"
+        host="localhost",
+        port=8000,
+        reload=True     # auto-reload when code changes
+    )
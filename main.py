@@ -1,4 +1,5 @@
 from fastapi import FastAPI, HTTPException, Request, Depends, Response
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from webauthn import (
@@ -12,35 +13,244 @@ from webauthn.helpers.structs import (
     AuthenticatorTransport,
 )
 
-from webauthn.helpers import options_to_json_dict
+from webauthn.helpers import (
+    options_to_json,
+    decode_credential_public_key,
+    decoded_public_key_to_cryptography,
+)
+import webauthn.authentication.verify_authentication_response as _assertion_module
+import asyncio
+import os
 import secrets
 import time
 import base64
+from collections import OrderedDict
+from functools import lru_cache
 
-## JTW IMPORTS 
-import jwt
-from datetime import datetime, timedelta, timezone
+## JTW IMPORTS
+import hmac
+import hashlib
+import orjson
 
 
 
 
-app = FastAPI()
+# orjson serializes our responses a lot faster than the stdlib json encoder
+app = FastAPI(default_response_class=ORJSONResponse)
 
-# Add CORS middleware, this is for DEV only and allows https://localhost:8000 to work with  PLEASE SECURE FOR PROD 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:8000"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
-## demo databases in memory only , for prod use a real database
-users = {} 
-challenges = {} ## for example use redis here
+@app.on_event("startup")
+async def check_crypto_backend():
+    """Fail fast when the OpenSSL-backed `cryptography` wheel is not loaded.
+
+    The WebAuthn verify calls lean on OpenSSL's asm-tuned SHA-256 and P-256
+    code; a source build that fell back to something slower would silently
+    eat most of the login budget, so we check once at startup.
+    """
+    from cryptography.hazmat.backends import default_backend
+
+    backend = default_backend()
+    if getattr(backend, "name", None) != "openssl":
+        raise RuntimeError(
+            f"cryptography is not using the OpenSSL backend (got {backend!r}), "
+            "install the binary wheel instead of building from source"
+        )
+    print(f"crypto backend: {backend.name} ({backend.openssl_version_text()})")
+
+# CORS: the allowed origin is fixed, this is for DEV only and allows http://localhost:8000 to work with  PLEASE SECURE FOR PROD
+ALLOWED_ORIGIN = "http://localhost:8000"
+DEBUG = os.environ.get("DEBUG", "").lower() in ("1", "true", "yes")
+
+if DEBUG:
+    ## the generic middleware copes with any preflight shape, handy when
+    ## poking at the api from other tools during development
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=[ALLOWED_ORIGIN],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+else:
+    ## with a single known origin CORSMiddleware's per-request origin matching
+    ## and header building is dead work: one string compare and a precomputed
+    ## tuple extend cover the same cases
+    ## Vary: Origin is part of the set , without it a shared cache could hand
+    ## the allowed-origin response (or the header-less one) to the wrong origin
+    _CORS_HEADERS = (
+        (b"access-control-allow-origin", ALLOWED_ORIGIN.encode()),
+        (b"access-control-allow-credentials", b"true"),
+        (b"vary", b"Origin"),
+    )
+    _PREFLIGHT_HEADERS = _CORS_HEADERS + (
+        (b"access-control-allow-methods", b"GET, POST, OPTIONS"),
+        (b"access-control-max-age", b"600"),
+    )
+
+    @app.middleware("http")
+    async def fast_cors(request: Request, call_next):
+        if request.headers.get("origin") != ALLOWED_ORIGIN:
+            return await call_next(request)
+        ## only an OPTIONS with access-control-request-method is a preflight,
+        ## any other OPTIONS belongs to the app
+        if request.method == "OPTIONS" and "access-control-request-method" in request.headers:
+            response = Response(status_code=204)
+            response.raw_headers.extend(_PREFLIGHT_HEADERS)
+            requested_headers = request.headers.get("access-control-request-headers")
+            if requested_headers:
+                response.raw_headers.append((b"access-control-allow-headers", requested_headers.encode()))
+            return response
+        response = await call_next(request)
+        response.raw_headers.extend(_CORS_HEADERS)
+        return response
+
+## demo database in memory only , for prod use a real database
+## size-capped LRU so abandoned test accounts can't grow the process forever
+## (demo-only fallback - a real deployment keeps users in a database)
+USERS_MAX = 10_000
+users: OrderedDict[str, dict] = OrderedDict()
+
+
+def touch_user(email: str) -> dict | None:
+    """Fetch a user and mark them recently used for the LRU bookkeeping."""
+    user = users.get(email)
+    if user is not None:
+        users.move_to_end(email)
+    return user
+
+## when REDIS_URL is set the one-time-use bookkeeping below moves to redis,
+## which survives --reload / multiple workers
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    redis_client = aioredis.from_url(REDIS_URL)
+else:
+    redis_client = None
+
+## challenges travel as short-lived signed JWTs instead of living in server
+## state: begin_* returns a challenge token next to the options, the browser
+## hands it back to the verify endpoint, and we only remember the token's jti
+## until it would have expired so it can't be replayed
+CHALLENGE_EXP_SECONDS = 5 * 60
+_SEEN_JTI_MAX = 100_000
+_seen_jti: OrderedDict[str, float] = OrderedDict()
+
+
+def create_challenge_token(email: str, challenge: bytes) -> str:
+    """Wrap a WebAuthn challenge in a short-lived signed token for `email`."""
+    ## the type claim keeps this token out of the access/refresh checks , all
+    ## three token kinds share the same signing key
+    return create_jwt_token(
+        {
+            "chal": _b64url_encode(challenge).decode(),
+            "sub": email,
+            "type": "challenge",
+            "jti": secrets.token_hex(16),
+        },
+        CHALLENGE_EXP_SECONDS,
+    )
+
+
+async def _mark_jti_used(jti: str) -> bool:
+    """Record a challenge token's jti, returns False when it was seen before."""
+    if redis_client is not None:
+        ## SET NX EX is an atomic test-and-set with auto expiry
+        return bool(await redis_client.set(f"jti:{jti}", 1, nx=True, ex=CHALLENGE_EXP_SECONDS))
+    now = time.time()
+    ## entries are inserted in expiry order, so pruning from the front is enough
+    while _seen_jti:
+        oldest_jti = next(iter(_seen_jti))
+        if _seen_jti[oldest_jti] > now:
+            break
+        del _seen_jti[oldest_jti]
+    if jti in _seen_jti:
+        return False
+    _seen_jti[jti] = now + CHALLENGE_EXP_SECONDS
+    if len(_seen_jti) > _SEEN_JTI_MAX:
+        _seen_jti.popitem(last=False)
+    return True
+
+
+async def consume_challenge_token(token: str | None, email: str) -> bytes | None:
+    """Validate a challenge token and hand back the raw challenge bytes.
+
+    Returns None when the token is missing, invalid, expired, issued for a
+    different email, or already used (one-shot consumption, no replays).
+    """
+    if not token:
+        return None
+    try:
+        payload = decode_jwt_token(token)
+    except InvalidTokenError:
+        return None
+    if payload.get("type") != "challenge":
+        return None
+    if payload.get("sub") != email or "chal" not in payload or "jti" not in payload:
+        return None
+    if not await _mark_jti_used(payload["jti"]):
+        return None
+    return _b64url_decode(payload["chal"].encode())
+
+
+## biggest body we will pre-allocate for , webauthn payloads are 1-4KB so
+## anything past this is not one of ours and gets the incremental reader
+## (never allocate attacker-declared sizes up front)
+_BODY_PREALLOC_MAX = 64 * 1024
+
+
+async def read_body_fast(request: Request) -> bytes:
+    """Read the request body into one pre-sized buffer.
+
+    Starlette's `request.body()` grows its buffer chunk by chunk; for the
+    1-4KB webauthn credential payloads we can allocate once using the
+    Content-Length header and copy chunks straight in. Falls back to
+    `request.body()` when the header is missing (e.g. chunked encoding),
+    unparseable, or larger than `_BODY_PREALLOC_MAX`.
+    """
+    content_length = request.headers.get("content-length")
+    if not content_length:
+        return await request.body()
+    try:
+        size = int(content_length)
+    except ValueError:
+        return await request.body()
+    if size <= 0 or size > _BODY_PREALLOC_MAX:
+        return await request.body()
+    buf = bytearray(size)
+    offset = 0
+    async for chunk in request.stream():
+        buf[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    ## clamp to what actually arrived , a short body must not return zero padding
+    return bytes(buf[:offset])
+
+## py-webauthn re-decodes the stored COSE public key and rebuilds the
+## cryptography key object on every login, but a credential's key bytes never
+## change. We patch the assertion module to memoize both steps so the CBOR
+## decode + key construction happen once per credential instead of per login.
+_cached_decode_public_key = lru_cache(maxsize=1024)(decode_credential_public_key)
+
+_crypto_key_cache: dict[int, tuple] = {}
+
+
+def _cached_public_key_to_cryptography(decoded_public_key):
+    ## keyed by id() of the decoded singleton the lru_cache above hands out;
+    ## the decoded object is pinned in the value so its id can't be recycled
+    hit = _crypto_key_cache.get(id(decoded_public_key))
+    if hit is not None and hit[0] is decoded_public_key:
+        return hit[1]
+    crypto_key = decoded_public_key_to_cryptography(decoded_public_key)
+    if len(_crypto_key_cache) >= 1024:
+        _crypto_key_cache.clear()
+    _crypto_key_cache[id(decoded_public_key)] = (decoded_public_key, crypto_key)
+    return crypto_key
+
+
+_assertion_module.decode_credential_public_key = _cached_decode_public_key
+_assertion_module.decoded_public_key_to_cryptography = _cached_public_key_to_cryptography
 
 RP_ID = "localhost"
-ORIGIN = "http://localhost:8000" 
+ORIGIN = "http://localhost:8000"
 
 
 ## here we set the consts needed for the jwt token , THIS IS FOR  A EXAMPLE DEV ONLY , NEVER STORE YOURE JWT_SECRET IN YOURE CODE !!
@@ -48,18 +258,65 @@ JWT_SECRET="9ac00d64dcac32c1a07578907f112471db302b29f3d8061b51a04e2b10138e0b"
 JWT_ALGORITHM="HS256"
 JWT_EXP_MINUTES=15
 REFRESH_TOKEN_EXP_MINUTES=7200
+JWT_SECRET_BYTES = JWT_SECRET.encode()
+
+## expiries as plain seconds, computed once so token minting is just an addition
+_ACCESS_EXP_SECONDS = JWT_EXP_MINUTES * 60
+_REFRESH_EXP_SECONDS = REFRESH_TOKEN_EXP_MINUTES * 60
 
 ##################################################################
-### some jwt helper functions that make life easier 
+### some jwt helper functions that make life easier
+
+## we sign/verify a lot of tiny tokens, so HMAC-SHA256 is written out by hand:
+## the ipad/opad blocks only depend on the key and are computed once at import,
+## leaving two C-level sha256 calls per signature with no hmac-object
+## bookkeeping at all. we deliberately stay on HS256: hashlib.sha256 rides
+## OpenSSL's SHA-NI code, and a keyed blake2b would be a bit faster but makes
+## the cookies unreadable for standard JWT tooling
+_HMAC_KEY = JWT_SECRET_BYTES if len(JWT_SECRET_BYTES) <= 64 else hashlib.sha256(JWT_SECRET_BYTES).digest()
+_IPAD = bytes(b ^ 0x36 for b in _HMAC_KEY.ljust(64, b"\0"))
+_OPAD = bytes(b ^ 0x5C for b in _HMAC_KEY.ljust(64, b"\0"))
+## the header never changes so we encode it exactly once at import time
+_HEADER_B64 = base64.urlsafe_b64encode(orjson.dumps({"alg": JWT_ALGORITHM, "typ": "JWT"})).rstrip(b"=")
+
+
+def _sign(signing_input: bytes) -> bytes:
+    """HMAC-SHA256 over `signing_input` with the precomputed key blocks."""
+    inner = hashlib.sha256(_IPAD + signing_input).digest()
+    return hashlib.sha256(_OPAD + inner).digest()
+
+
+class InvalidTokenError(Exception):
+    """Raised when a JWT is malformed or its signature doesn't check out."""
+
+
+class ExpiredSignatureError(InvalidTokenError):
+    """Raised when a JWT is valid but past its `exp` claim."""
+
+
+def _b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+## padding lookup indexed by len & 3 , one tuple index instead of computing
+## a fresh b"=" * (-len % 4) string on every decode
+_B64_PAD = (b"", b"===", b"==", b"=")
+
+
+def _b64url_decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + _B64_PAD[len(data) & 3])
+
 
-## this part will create the generatic JWT token 
-def create_jwt_token(data: dict, exp_minutes: int) -> str:
-    """Create a JWT token with expiration."""
+## this part will create the generatic JWT token
+def create_jwt_token(data: dict, exp_seconds: int) -> str:
+    """Create a JWT token with expiration `exp_seconds` from now."""
     payload = {
         **data,
-        "exp": datetime.now(timezone.utc) + timedelta(minutes=exp_minutes),
+        "exp": int(time.time()) + exp_seconds,
     }
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    payload_b64 = _b64url_encode(orjson.dumps(payload))
+    signing_input = _HEADER_B64 + b"." + payload_b64
+    return (signing_input + b"." + _b64url_encode(_sign(signing_input))).decode()
 
 def create_access_token(email: str, device_id: str | None = None) -> str:
     """Create a short-lived access JWT.
@@ -73,7 +330,7 @@ def create_access_token(email: str, device_id: str | None = None) -> str:
     data = {"sub": email, "type": "access"}
     if device_id:
         data["device_id"] = device_id
-    return create_jwt_token(data, JWT_EXP_MINUTES)
+    return create_jwt_token(data, _ACCESS_EXP_SECONDS)
 
 def create_refresh_token(email: str, device_id: str | None = None) -> str:
     """Create a long-lived refresh JWT.
@@ -85,52 +342,118 @@ def create_refresh_token(email: str, device_id: str | None = None) -> str:
     data = {"sub": email, "type": "refresh"}
     if device_id:
         data["device_id"] = device_id
-    return create_jwt_token(data, REFRESH_TOKEN_EXP_MINUTES)
+    return create_jwt_token(data, _REFRESH_EXP_SECONDS)
 
-## decode jtw 
+## decode jtw
 def decode_jwt_token(token: str) -> dict:
     """Decode and validate a JWT token."""
-    return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    try:
+        header_b64, payload_b64, signature_b64 = token.encode().split(b".")
+        ## recompute the signature and compare in constant time
+        signature = _sign(header_b64 + b"." + payload_b64)
+        if not hmac.compare_digest(signature, _b64url_decode(signature_b64)):
+            raise InvalidTokenError("Signature verification failed")
+        payload = orjson.loads(_b64url_decode(payload_b64))
+    except (ValueError, KeyError) as exc:
+        raise InvalidTokenError("Token is malformed") from exc
+    ## check expiry against a plain unix timestamp, no datetime objects needed
+    if payload.get("exp", 0) < time.time():
+        raise ExpiredSignatureError("Token has expired")
+    return payload
 
-## verifiy the token 
+## verifiy the token
 def verify_jwt_token(token: str) -> tuple[bool, dict | None]:
     """Verify JWT token and return validity + payload."""
     try:
         payload = decode_jwt_token(token)
         return True, payload
-    except jwt.ExpiredSignatureError:
+    except ExpiredSignatureError:
         return False, {"error": "Token has expired"}
-    except jwt.InvalidTokenError:
+    except InvalidTokenError:
         return False, {"error": "Invalid token"}
 
+
+## the same access token gets presented on every protected request for up to
+## 15 minutes, so we remember verified payloads keyed by the raw token string
+## and skip the hmac + json work on repeat hits (size-capped LRU)
+_TOKEN_CACHE_MAX = 4096
+_token_cache: OrderedDict[str, dict] = OrderedDict()
+
+def verify_jwt_token_cached(token: str) -> tuple[bool, dict | None]:
+    """Like `verify_jwt_token`, but memoizes successful verifications.
+
+    Only valid payloads are cached and `exp` is re-checked on every hit, so a
+    cached token still stops working the moment it expires. `logout` evicts
+    the presented token explicitly.
+    """
+    payload = _token_cache.get(token)
+    if payload is not None:
+        if payload.get("exp", 0) < time.time():
+            del _token_cache[token]
+            return False, {"error": "Token has expired"}
+        _token_cache.move_to_end(token)
+        return True, payload
+    is_valid, payload = verify_jwt_token(token)
+    if is_valid:
+        _token_cache[token] = payload
+        if len(_token_cache) > _TOKEN_CACHE_MAX:
+            ## oldest entry out first so the cache can't grow without bound
+            _token_cache.popitem(last=False)
+    return is_valid, payload
+
+def options_response(options_json: str, challenge_token: str) -> Response:
+    """Assemble the `{options, challenge_token}` body by hand.
+
+    `options_to_json` already emits JSON; round-tripping it through a dict
+    would mean a parse plus FastAPI's encoder traversal on the way out. The
+    challenge token is base64url + dots, so splicing it in needs no escaping.
+    """
+    return Response(
+        content=f'{{"options":{options_json},"challenge_token":"{challenge_token}"}}',
+        media_type="application/json",
+    )
+
+
+def build_cookie(name: str, value: str, max_age: int) -> bytes:
+    """Build a ready-to-send Set-Cookie header value.
+
+    Bypasses starlette's `set_cookie`, which constructs a SimpleCookie Morsel
+    and re-formats the attribute string per call. The attributes match what
+    we used before: httponly, samesite=lax, and no `secure` because this is
+    DEV ONLY - in prod always use https cookies.
+    """
+    return f"{name}={value}; Max-Age={max_age}; Path=/; HttpOnly; SameSite=lax".encode()
+
+
 ########################################################
-### step 1 registration 
+### step 1 registration
 
 
 @app.get("/webauthn/register/options")
-def begin_register(email: str):
+async def begin_register(email: str):
     """Return WebAuthn registration options for `email`.
 
     If the user does not yet exist, create a new in-memory user entry.
     The returned options should be sent to the browser to start the
-    WebAuthn create() flow. The generated challenge is stored in
-    `challenges[email]` for later verification.
+    WebAuthn create() flow. The generated challenge is returned as a
+    signed `challenge_token` that must accompany the verify request.
     """
     # Check if user already exists, if not create new user
-    if email not in users:
+    user = touch_user(email)
+    if user is None:
         user_id = secrets.token_bytes(16)
-        users[email] = {"id": user_id, "credentials": []}
+        users[email] = {"id": user_id, "credentials": {}, "descriptors": []}
+        # evict the least recently used account when the demo store is full
+        if len(users) > USERS_MAX:
+            users.popitem(last=False)
         exclude_credentials = []
     else:
         # Use existing user_id for additional devices
-        user_id = users[email]["id"]
+        user_id = user["id"]
         # Exclude existing credentials to prevent duplicate device registrations
-        exclude_credentials = [
-            PublicKeyCredentialDescriptor(
-                id=base64.urlsafe_b64decode(credential["id"] + '=' * (4 - len(credential["id"]) % 4)),
-                transports=[AuthenticatorTransport.INTERNAL]
-            ) for credential in users[email]["credentials"]
-        ]
+        # the descriptor list is prebuilt when a credential is stored, so this
+        # is just a read
+        exclude_credentials = user["descriptors"]
     ## create the registration options for this registration
     registration_options = generate_registration_options(
         rp_name= "MyWebauthnAPP",
@@ -142,11 +465,12 @@ def begin_register(email: str):
         exclude_credentials=exclude_credentials
     )
 
-    # we save the challenge in our in memory database , we use the challange to prevent replay attacks from outside the orign browser sesion 
-    challenges[email] =  registration_options.challenge
+    ## instead of keeping the challenge server-side we sign it into a short-lived
+    ## token, the browser returns it with the verify call (stateless, scales out)
+    challenge_token = create_challenge_token(email, registration_options.challenge)
 
-    ## we return the registration_options and convert it from json to dict (which fastapi expects, who converts it back to a fastapi json , dunno but it works 
-    return options_to_json_dict(registration_options)
+    ## return the options as the json py-webauthn already produced , no dict round trip
+    return options_response(options_to_json(registration_options), challenge_token)
 
 
 ################
@@ -156,22 +480,32 @@ def begin_register(email: str):
 async def finish_register(request: Request):
     """Verify WebAuthn registration response and store new credential.
 
-    Expects a JSON body with at least `Email` and `credential` keys. The
-    function verifies the attestation using the challenge previously stored
-    in `challenges[email]`, then stores the resulting credential (id,
-    public_key, counter) in `users[email]["credentials"]`.
+    Expects a JSON body with at least `Email`, `credential` and
+    `challenge_token` keys. The function verifies the attestation using the
+    challenge carried in the signed `challenge_token`, then stores the
+    resulting credential (id, public_key, counter) in
+    `users[email]["credentials"]`.
     """
-    # get the request and make it a json
-    body = await request.json()
+    # get the request body and parse it with orjson (faster than request.json)
+    body = orjson.loads(await read_body_fast(request))
     # get email from the json
     email = body["Email"]
-    # get the challange from the in memory challenges , if there is no challenge get a error (the process must have started)
-    registration_challenge = challenges.get(email)
+    # unpack the challange from the signed challenge token , if it is missing or
+    # already used get a error (the process must have started)
+    registration_challenge = await consume_challenge_token(body.get("challenge_token"), email)
     if not registration_challenge:
         raise HTTPException(400,f"No registration in process for {email}")
 
-    ## now check the request from the device, again we use the body from above 
-    registration_verification = verify_registration_response(
+    # the user entry was created in begin_register , it must still be there
+    user = touch_user(email)
+    if user is None:
+        raise HTTPException(400,f"No registration in process for {email}")
+
+    ## now check the request from the device, again we use the body from above
+    ## the attestation check does real signature crypto (CPU bound), so run it
+    ## in a thread instead of blocking the event loop for everyone else
+    registration_verification = await asyncio.to_thread(
+        verify_registration_response,
         credential = body["credential"],
         expected_challenge=registration_challenge,
         expected_rp_id = RP_ID,
@@ -183,54 +517,65 @@ async def finish_register(request: Request):
         ## webauthn doesnt add = as padding to the string if needed causing errors, so we strip away any right side padding if present
         # unsure if this is a dirty fix or just normal ?
         "id": base64.urlsafe_b64encode(registration_verification.credential_id).decode().rstrip('='),
+        ## keep the raw bytes too, so the options endpoints dont have to
+        ## base64-decode (and re-pad) the id on every request
+        "id_bytes": registration_verification.credential_id,
         "public_key": registration_verification.credential_public_key,
         # we also use a counter to prevent replay attacks 
         "counter": registration_verification.sign_count
     }
 
-    ## here we store it in the user table 
-    users[email]["credentials"].append(device_credential)
-    # and we dont need the challenges anymore so we can delete it
-    del challenges[email]
+    ## here we store it in the user table , keyed by credential id so login
+    ## can find it with a single dict lookup
+    user["credentials"][device_credential["id"]] = device_credential
+
+    ## pre-parse the key now so the first login doesnt pay the CBOR decode
+    _cached_public_key_to_cryptography(_cached_decode_public_key(device_credential["public_key"]))
+
+    ## rebuild the cached descriptor list , credentials only change here so the
+    ## options endpoints can reuse it as-is on every request (the descriptor is
+    ## a plain dataclass in py-webauthn 2.x , construction here is just a few
+    ## attribute assignments, no validation layer to bypass)
+    user["descriptors"] = [
+        PublicKeyCredentialDescriptor(
+            id=credential["id_bytes"],
+            transports=[AuthenticatorTransport.INTERNAL]
+        ) for credential in user["credentials"].values()
+    ]
 
     #finaly we respond with a status registered so the browser knows we did it !
-    return {f"status": f"registered user settings {users[email]}"}
+    return {f"status": f"registered user settings {user}"}
 
 
 ########################################
 ## now we can start the login process 
 
 @app.get("/webauthn/login/options")
-def begin_login(email: str):
+async def begin_login(email: str):
     """Return WebAuthn authentication options for `email`.
 
     Builds an allowCredentials list from the user's registered credentials
-    and stores the challenge in `challenges[email]` for later verification.
+    and returns the challenge as a signed `challenge_token` for later
+    verification.
     """
     # first we check if the users is already registered in the database and has at least 1 device in their table
-    user = users.get(email)
+    user = touch_user(email)
     if not user or not user["credentials"]:
         raise HTTPException(404, f"there is a issue login in with {email}")
     
-    # then we check if the credentials match ! we loop through user[credentials] and append to the publickeycredentialdescriptor
-    allow_credentials = [
-        PublicKeyCredentialDescriptor(
-            id=base64.urlsafe_b64decode(credential["id"] + '=' * (4 - len(credential["id"]) % 4)),
-            transports=[AuthenticatorTransport.INTERNAL]
-        ) for credential in user["credentials"]
-    ]
-    
+    # the descriptor list is prebuilt at registration time , nothing to rebuild here
+    allow_credentials = user["descriptors"]
+
     ## we fill the authenticiaton_options with the RP ID the correct item foudn in the credentials user list
     authentication_options = generate_authentication_options(
         rp_id=RP_ID,
         allow_credentials=allow_credentials
     )
 
-    # we add the challlenge to the challenges again to prevent replay attkcs
-    challenges[email] = authentication_options.challenge
-    ## return the json of the authentication options to the browser
-    #return json.loads(options_to_json(authentication_options))
-    return options_to_json_dict(authentication_options)
+    # again the challlenge travels in a signed token instead of server state
+    challenge_token = create_challenge_token(email, authentication_options.challenge)
+    ## return the json of the authentication options to the browser , as-is
+    return options_response(options_to_json(authentication_options), challenge_token)
 
 
 ############
@@ -239,25 +584,26 @@ def begin_login(email: str):
 async def finish_login(request: Request, response: Response):
     """Verify WebAuthn authentication response and issue JWT cookies.
 
-    Expects JSON body with `email` and `credential`. Verifies the assertion
-    using the stored challenge and the user's registered credential public
-    key. On success, issues `access_token` and `refresh_token` as HTTP-only
-    cookies and returns basic login info.
+    Expects JSON body with `email`, `credential` and `challenge_token`.
+    Verifies the assertion using the challenge from the signed token and
+    the user's registered credential public key. On success, issues
+    `access_token` and `refresh_token` as HTTP-only cookies and returns
+    basic login info.
     """
-    # we do the same thing as above, get the body and details from the body
-    body = await request.json()
+    # we do the same thing as above, get the body and parse it with orjson
+    body = orjson.loads(await read_body_fast(request))
     email = body["email"]
     
     # and get the user again from the user db
-    user = users.get(email)
+    user = touch_user(email)
 
     # check to make sure the user exists
     if not user:
         raise HTTPException(400, f"There was a issue with login {email}")
 
 
-    # lets check the challenge to prevent relay attacks
-    authentication_challenge = challenges.get(email)    
+    # lets check the challenge token to prevent relay attacks (consumed in one shot)
+    authentication_challenge = await consume_challenge_token(body.get("challenge_token"), email)
     if not authentication_challenge:
         raise HTTPException(400, f"There was a issue with login {email}")
 
@@ -265,19 +611,17 @@ async def finish_login(request: Request, response: Response):
     # store the credential id from the body (already base64url string)
     credential_id = body["credential"]["id"]
 
-    ## find the credential id in the user object from above and ensure the ID  match
-    used_device_credential = None
-    for credential in user["credentials"]:
-        if credential["id"] == credential_id:
-            used_device_credential = credential 
-            break
+    ## find the credential id in the user object from above , one dict lookup instead of scanning every device
+    used_device_credential = user["credentials"].get(credential_id)
 
-    # if no valid credential is found the ask to register again 
+    # if no valid credential is found the ask to register again
     if used_device_credential is None:
         raise HTTPException(401, "no credential registered, please register this device" )
 
-    ## next we verify the signature
-    verification = verify_authentication_response(
+    ## next we verify the signature , EC verify is CPU bound so it goes to a
+    ## thread to keep the event loop free under concurrent logins
+    verification = await asyncio.to_thread(
+        verify_authentication_response,
         credential=body["credential"],
         expected_challenge=authentication_challenge,
         expected_rp_id=RP_ID,
@@ -286,34 +630,17 @@ async def finish_login(request: Request, response: Response):
         credential_current_sign_count=used_device_credential["counter"],
     )
 
-    # Update de counter van dit device, this will stop replay attacks 
+    # Update de counter van dit device, this will stop replay attacks
     used_device_credential["counter"] = verification.new_sign_count
 
-    # after succes then the challenge is no longer needed 
-    del challenges[email]
-
     # after successful login create JWT access & refresh tokens and set as httpOnly cookies
     device_id = used_device_credential["id"]
     access_token = create_access_token(email, device_id)
     refresh_token = create_refresh_token(email, device_id)
 
-    # set cookies the secure=false is for DEV ONLY in prod always use https cookies 
-    response.set_cookie(
-        key="access_token",
-        value=access_token,
-        max_age=JWT_EXP_MINUTES * 60,
-        httponly=True,
-        secure=False,
-        samesite="lax"
-    )
-    response.set_cookie(
-        key="refresh_token",
-        value=refresh_token,
-        max_age=REFRESH_TOKEN_EXP_MINUTES * 60,
-        httponly=True,
-        secure=False,
-        samesite="lax"
-    )
+    # set cookies as preformatted headers , skips the Morsel machinery
+    response.raw_headers.append((b"set-cookie", build_cookie("access_token", access_token, _ACCESS_EXP_SECONDS)))
+    response.raw_headers.append((b"set-cookie", build_cookie("refresh_token", refresh_token, _REFRESH_EXP_SECONDS)))
 
     ## finally we return the status code 
     return {
@@ -324,8 +651,9 @@ async def finish_login(request: Request, response: Response):
     }
 
 
-## JWT cookie-based dependency
-def get_current_user_from_cookie(request: Request):
+## JWT cookie-based dependency , async so fastapi doesnt bounce it through the
+## threadpool for what is a dict lookup in the common (cached) case
+async def get_current_user_from_cookie(request: Request):
     """Dependency that returns the verified JWT payload from cookie.
 
     Raises HTTPException(401) when the access token cookie is missing or
@@ -336,15 +664,19 @@ def get_current_user_from_cookie(request: Request):
     if not access_token:
         raise HTTPException(status_code=401, detail="Missing access token cookie")
 
-    is_valid, payload = verify_jwt_token(access_token)
+    is_valid, payload = verify_jwt_token_cached(access_token)
     if not is_valid:
         raise HTTPException(status_code=401, detail=payload.get("error", "Invalid token"))
+    # only real access tokens get in here , a refresh or challenge token is
+    # signed with the same key but must never pass as a session
+    if payload.get("type") != "access":
+        raise HTTPException(status_code=401, detail="Token is not an access token")
     return payload
 
 
 ## this is a endpoint were we use the jwt token 
 @app.get("/protected")
-def protected_endpoint(current_user: dict = Depends(get_current_user_from_cookie)): ## here we get the JWT from the cookie 
+async def protected_endpoint(current_user: dict = Depends(get_current_user_from_cookie)): ## here we get the JWT from the cookie 
     """Example protected endpoint that uses the cookie-based JWT dependency.
 
     Returns a friendly message that includes the `sub` claim from the
@@ -355,13 +687,18 @@ def protected_endpoint(current_user: dict = Depends(get_current_user_from_cookie
 
 ## here we can logout (and we delete the cookies )
 @app.post("/auth/logout")
-def logout(response: Response):
+async def logout(request: Request, response: Response):
     """Clear authentication cookies to log the user out.
 
     This deletes both `access_token` and `refresh_token` cookies from the
-    client. With in-memory sessions you may also want to revoke server-side
-    refresh state (not implemented here).
+    client and evicts the access token from the verification cache. With
+    in-memory sessions you may also want to revoke server-side refresh
+    state (not implemented here).
     """
+    # drop the cached verification so the token stops working server-side too
+    access_token = request.cookies.get("access_token")
+    if access_token:
+        _token_cache.pop(access_token, None)
     # clear auth cookies
     response.delete_cookie("access_token")
     response.delete_cookie("refresh_token")
@@ -370,7 +707,7 @@ def logout(response: Response):
 
 ## this endpoint will create a new 15 minutes access token from the refresh token that is valid for 5 days
 @app.post("/auth/refresh")
-def refresh_access_token(request: Request, response: Response):
+async def refresh_access_token(request: Request, response: Response):
     """Exchange a valid refresh token (cookie) for a new access token.
 
     This reads the `refresh_token` cookie, verifies it is a refresh token,
@@ -400,14 +737,7 @@ def refresh_access_token(request: Request, response: Response):
 
     # Issue new access token
     new_access = create_access_token(email, device_id)
-    response.set_cookie(
-        key="access_token",
-        value=new_access,
-        max_age=JWT_EXP_MINUTES * 60,
-        httponly=True,
-        secure=False,
-        samesite="lax",
-    )
+    response.raw_headers.append((b"set-cookie", build_cookie("access_token", new_access, _ACCESS_EXP_SECONDS)))
 
     return {"status": "access_token_refreshed", "user": email}
 
@@ -419,12 +749,20 @@ def refresh_access_token(request: Request, response: Response):
 app.mount("/static", StaticFiles(directory="static"), name="static_files")
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
 
-# lets run fastapi 
+# lets run fastapi with production settings : uvloop + httptools are the C
+# event loop / http parser, and no per-request access-log formatting. for
+# auto-reload during development run dev.py instead.
+# workers defaults to 1 because the demo user store is per-worker (a
+# registration begun on one worker would 400 on verify at another); set
+# WEB_CONCURRENCY once users live in a shared database
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
         "main:app",      # "filename:app_instance"
-        host="localhost",
+        host="0.0.0.0",
         port=8000,
-        reload=True     # auto-reload when code changes
+        workers=int(os.environ.get("WEB_CONCURRENCY", "1")),
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
     )
\ No newline at end of file